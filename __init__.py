@@ -1 +1 @@
-from data_analysis import VehicleData
\ No newline at end of file
+from .data_analysis import VehicleData
\ No newline at end of file
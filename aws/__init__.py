@@ -1 +1 @@
-from .athena_client import AthenClient
+from .athena_client import AthenClient, QueryHandle
\ No newline at end of file
@@ -1,86 +1,470 @@
+from contextlib import nullcontext
 import io
 import logging
+import threading
+import time
 
 import boto3
 import pandas as pd
 
+TERMINAL_STATES = ("SUCCEEDED", "FAILED", "CANCELLED")
+# The maximal number of rows athena returns in a single GetQueryResults page.
+RESULTS_PAGE_SIZE = 1000
+INTEGER_TYPES = ("tinyint", "smallint", "integer", "bigint")
+FLOAT_TYPES = ("float", "real", "double", "decimal")
+
+
+class _Flight:
+    """An identical query which is in flight, shared by all the callers which coalesce on it."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.handle = None
+        # The number of callers which joined the flight and didn't abandon it.
+        self.waiters = 0
+
+
+# The coalesced queries which are in flight in this process, by (database, query).
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _land(key: tuple, flight: _Flight):
+    """Forgets an in-flight query, so the next identical query will be sent again.
+
+    Args:
+        key (tuple): The (database, query) key.
+        flight (_Flight): The flight to forget.
+    """
+    with _flights_lock:
+        if _flights.get(key) is flight:
+            del _flights[key]
+
+
+class QueryHandle:
+    """A handle to a single query execution in athena.
+    The handle holds its own execution id, status and statistics, so any number
+    of handles may be in flight (and shared between threads) on one AthenClient.
+    """
+
+    def __init__(self, client: "AthenClient", execution_id: str) -> None:
+        """Ctor.
+
+        Args:
+            client (AthenClient): The client which started the query.
+            execution_id (str): The execution id (query id).
+        """
+        self._client = client
+        self._execution_id = execution_id
+        self._details = None
+        self._results = None
+        self._callbacks = []
+        self._flight = None
+        self._lock = threading.Lock()
+
+    @property
+    def query_id(self) -> str:
+        """A property for getting execution id.
+
+        Returns:
+            str: The execution id.
+        """
+        return self._execution_id
+
+    def update_query_details(self) -> None:
+        """Fetches from athena the details on the query, unless the query
+        has already reached a final state."""
+        with self._lock:
+            if self._details and self._state in TERMINAL_STATES:
+                return
+            self._details = self._client._client.get_query_execution(
+                QueryExecutionId=self._execution_id
+            )
+            callbacks = []
+            if self._state in TERMINAL_STATES:
+                callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Registers a function to call (with the handle) once the query
+        is known to have reached a final state.
+
+        Args:
+            callback: The function to call.
+        """
+        with self._lock:
+            if not (self._details and self._state in TERMINAL_STATES):
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    @property
+    def _state(self) -> str:
+        """The last known state of the query."""
+        return self._details["QueryExecution"]["Status"]["State"]
+
+    @property
+    def status(self) -> str:
+        """Fetch from athena the details on the query and returns
+        the status of the query.
+
+        Returns:
+            str: the current status.
+        """
+        self.update_query_details()
+        return self._state
+
+    @property
+    def statistics(self) -> dict:
+        """Fetch from athena the details on the query and returns its statistics
+        (e.g. DataScannedInBytes, TotalExecutionTimeInMillis).
+
+        Returns:
+            dict: The query statistics.
+        """
+        self.update_query_details()
+        return self._details["QueryExecution"].get("Statistics", {})
+
+    def done(self) -> bool:
+        """Checks whether the query has reached a final state.
+
+        Returns:
+            bool: True in case the query succeeded, failed or was cancelled.
+        """
+        return self.status in TERMINAL_STATES
+
+    def wait(self, timeout: float = None, interval: float = 0.1) -> str:
+        """Waits for the query to reach a final state.
+
+        Args:
+            timeout (float, optional): The maximum number of seconds to wait.
+                Defaults to None, which means wait forever.
+            interval (float, optional): The interval between status checks in seconds.
+                Defaults to 0.1.
+
+        Raises:
+            TimeoutError: In case the query didn't reach a final state within timeout.
+
+        Returns:
+            str: The final status.
+        """
+        start_time = time.perf_counter()
+        while not self.done():
+            if timeout is not None and time.perf_counter() - start_time >= timeout:
+                raise TimeoutError(
+                    f"The time limit of {timeout} seconds has exceeded for query {self._execution_id}."
+                )
+            time.sleep(interval)
+        return self._state
+
+    def result(self, timeout: float = None, interval: float = 0.1) -> pd.DataFrame:
+        """Waits for the query to succeed and returns its results.
+        The results are fetched only once and shared by all the callers.
+
+        Args:
+            timeout (float, optional): The maximum number of seconds to wait.
+                Defaults to None, which means wait forever.
+            interval (float, optional): The interval between status checks in seconds.
+                Defaults to 0.1.
+
+        Raises:
+            TimeoutError: In case the query didn't reach a final state within timeout.
+            RuntimeError: In case the query failed or was cancelled.
+
+        Returns:
+            pd.DataFrame: The query results.
+        """
+        status = self.wait(timeout, interval)
+        if status != "SUCCEEDED":
+            reason = self._details["QueryExecution"]["Status"].get(
+                "StateChangeReason", ""
+            )
+            raise RuntimeError(
+                f"Query {self._execution_id} has {status.lower()}. {reason}".strip()
+            )
+        with self._lock:
+            if self._results is None:
+                self._results = self._client._download(self._execution_id)
+        return self._results.copy()
+
+    def cancel(self) -> None:
+        """Stops the query execution in athena."""
+        self._client._client.stop_query_execution(QueryExecutionId=self._execution_id)
+
 
 class AthenClient:
-    """A class to handle query and retreival of data from aws s3."""
+    """A class to handle query and retreival of data from aws s3.
+    The client itself is stateless regarding queries: each query is tracked by
+    its own QueryHandle. The status, query_id and get_query_results members refer
+    to the query which was last sent by execute.
+    """
+
+    def __init__(
+        self, db: str, s3_results_path: str, max_api_rows: int = RESULTS_PAGE_SIZE
+    ) -> None:
+        """Ctor.
 
-    def __init__(self, db: str, s3_results_path: str) -> None:
+        Args:
+            db (str): The name of the database to query.
+            s3_results_path (str): The S3 uri athena writes the results to.
+            max_api_rows (int, optional): Results with up to that number of rows are
+                fetched directly with GetQueryResults, bigger results are downloaded
+                from S3. Defaults to RESULTS_PAGE_SIZE.
+        """
         self._logger = logging.getLogger(self.__class__.__name__)
         self._client = boto3.client("athena")
-        self._resource = boto3.resource("s3")
+        # boto3 clients are thread safe, unlike boto3 resources.
+        self._s3 = boto3.client("s3")
         self._bucket, self._folder = s3_results_path.split("//", 1)[1].split("/", 1)
         self._context_config = {"Database": db}
         self._results_config = {"OutputLocation": s3_results_path}
-        self._execution_id = None
-        self._details = None
+        self._max_api_rows = max_api_rows
+        self._handle = None
+        # An optional profiler (see RunProfiler) which measures the download
+        # and the decoding of the results separately.
+        self.profiler = None
 
-    def execute(self, query: str) -> int:
-        """Sends the Query to Athena and retrieves the execution id.
+    def submit(self, query: str, coalesce: bool = False) -> QueryHandle:
+        """Sends the Query to Athena and returns a handle to its execution.
+        When coalescing, an identical query (same database and SQL) which is already
+        in flight in this process is not sent again: the callers share its handle,
+        and so its execution and decoded results.
 
         Args:
             query (str): The SQL query.
+            coalesce (bool, optional): Whether to coalesce with an identical query
+                in flight. Defaults to False.
 
         Returns:
-            (int): The execution id (query id).
+            QueryHandle: The handle to the query execution.
+        """
+        if not coalesce:
+            return self._start(query)
+
+        key = (self._context_config["Database"], query)
+        with _flights_lock:
+            flight = _flights.setdefault(key, _Flight())
+            flight.waiters += 1
+        with flight.lock:
+            if flight.handle is None:
+                try:
+                    flight.handle = self._start(query)
+                except Exception:
+                    _land(key, flight)
+                    raise
+                flight.handle._flight = (key, flight)
+                flight.handle.add_done_callback(lambda handle: _land(key, flight))
+            return flight.handle
+
+    def abandon(self, handle: QueryHandle) -> None:
+        """Gives up on a query (e.g. after a timeout). A coalesced query which is still
+        shared by other callers keeps running for them, otherwise the query is cancelled
+        and forgotten, so the next identical query will be sent again.
+
+        Args:
+            handle (QueryHandle): The handle to the query.
+        """
+        if handle._flight:
+            key, flight = handle._flight
+            with _flights_lock:
+                flight.waiters -= 1
+                if flight.waiters > 0:
+                    return
+                if _flights.get(key) is flight:
+                    del _flights[key]
+        handle.cancel()
+
+    def _start(self, query: str) -> QueryHandle:
+        """Starts the query execution in athena.
+
+        Args:
+            query (str): The SQL query.
+
+        Returns:
+            QueryHandle: The handle to the query execution.
         """
-        self._execution_id = None
-        self._details = None
         query_execution = self._client.start_query_execution(
             QueryString=query,
             QueryExecutionContext=self._context_config,
             ResultConfiguration=self._results_config,
         )
-        self._execution_id = query_execution["QueryExecutionId"]
-        return self.query_id
+        return QueryHandle(self, query_execution["QueryExecutionId"])
+
+    def execute(self, query: str, coalesce: bool = False) -> QueryHandle:
+        """Sends the Query to Athena and keeps its handle as the current query.
+
+        Args:
+            query (str): The SQL query.
+            coalesce (bool, optional): Whether to coalesce with an identical query
+                in flight, see submit. Defaults to False.
+
+        Returns:
+            QueryHandle: The handle to the query execution.
+        """
+        self._handle = None
+        self._handle = self.submit(query, coalesce)
+        return self._handle
 
     def update_query_details(self) -> None:
-        """_summary_"""
-        self._details = self._client.get_query_execution(
-            QueryExecutionId=self._execution_id
-        )
+        """Fetches from athena the details on the current query."""
+        self._handle.update_query_details()
 
     @property
     def status(self) -> str:
-        """Fetch from athena the details on the query and returns
+        """Fetch from athena the details on the current query and returns
         the status of the query.
 
         Returns:
             str: the current status.
         """
-        self.update_query_details()
-        return self._details["QueryExecution"]["Status"]["State"]
+        return self._handle.status
+
+    def _phase(self, name: str, trace_memory: bool = False):
+        """Returns the context manager which measures a phase with the profiler (if set).
+
+        Args:
+            name (str): The name of the phase.
+            trace_memory (bool, optional): Whether to capture the peak allocations
+                of the phase. Defaults to False.
+        """
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(name, trace_memory=trace_memory)
+
+    def _download(self, execution_id: str) -> pd.DataFrame:
+        """Fetches the results of the given query. Small results are decoded directly
+        from GetQueryResults, which saves the S3 round trip, while results with more
+        than max_api_rows rows are downloaded from S3. As long as max_api_rows fits in
+        a single page, the page is just big enough for max_api_rows rows (and the header),
+        so a result which has more than one page is downloaded from S3 right after
+        the first page.
+        Both ways decode the columns according to their athena types, so the results
+        have the same dtypes whichever way was taken.
+        The download (the API calls) and the decoding are measured as separate phases.
+
+        Args:
+            execution_id (str): The execution id.
+
+        Returns:
+            pd.DataFrame: The query results.
+        """
+        paginator = self._client.get_paginator("get_query_results")
+        pages = paginator.paginate(
+            QueryExecutionId=execution_id,
+            PaginationConfig={
+                "PageSize": min(self._max_api_rows + 1, RESULTS_PAGE_SIZE)
+            },
+        )
+        columns = None
+        rows = []
+        body = None
+        with self._phase("download"):
+            for page in pages:
+                if columns is None:
+                    columns = page["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]
+                rows += page["ResultSet"]["Rows"]
+                # The first row is the header, not counted as a data row.
+                too_many = len(rows) - 1 >= self._max_api_rows
+                if "NextToken" in page and (
+                    self._max_api_rows <= RESULTS_PAGE_SIZE or too_many
+                ):
+                    body = self._download_csv(execution_id)
+                    break
+        with self._phase("decode", trace_memory=True):
+            if body is not None:
+                return self._decode_csv(body, columns)
+            return self._decode_rows(columns or [], rows)
+
+    @staticmethod
+    def _decode_rows(columns: list, rows: list) -> pd.DataFrame:
+        """Decodes the rows returned by GetQueryResults into typed columns.
+
+        Args:
+            columns (list): The ColumnInfo of the result set.
+            rows (list): The rows of the result set.
+
+        Returns:
+            pd.DataFrame: The decoded results.
+        """
+        names = [column["Name"] for column in columns]
+        values = [[item.get("VarCharValue") for item in row["Data"]] for row in rows]
+        # The first row of a SELECT query results holds the columns names.
+        if values and values[0] == names:
+            values = values[1:]
+        data = pd.DataFrame(values, columns=names, dtype=object)
+        return AthenClient._apply_types(data, columns)
+
+    @staticmethod
+    def _apply_types(data: pd.DataFrame, columns: list) -> pd.DataFrame:
+        """Converts the (string) columns of the results according to their athena types,
+        numbers and booleans are converted, while any other type is kept as string.
+
+        Args:
+            data (pd.DataFrame): The results, all the columns are strings.
+            columns (list): The ColumnInfo of the result set.
+
+        Returns:
+            pd.DataFrame: The typed results.
+        """
+        for column in columns:
+            name, column_type = column["Name"], column["Type"].lower()
+            if column_type in INTEGER_TYPES or column_type in FLOAT_TYPES:
+                data[name] = pd.to_numeric(data[name])
+            elif column_type == "boolean":
+                data[name] = data[name].map({"true": True, "false": False})
+        return data
+
+    def _download_csv(self, execution_id: str) -> bytes:
+        """Downloads the results of the given query from S3.
+
+        Args:
+            execution_id (str): The execution id.
+
+        Returns:
+            bytes: The query results in CSV format.
+        """
+        response = self._s3.get_object(
+            Bucket=self._bucket, Key=self._folder + execution_id + ".csv"
+        )
+        return response["Body"].read()
+
+    @staticmethod
+    def _decode_csv(body: bytes, columns: list) -> pd.DataFrame:
+        """Decodes the results downloaded from S3 into typed columns.
+
+        Args:
+            body (bytes): The query results in CSV format.
+            columns (list): The ColumnInfo of the result set.
+
+        Returns:
+            pd.DataFrame: The decoded results.
+        """
+        data = pd.read_csv(io.BytesIO(body), encoding="utf8", dtype=object)
+        return AthenClient._apply_types(data, columns)
 
     def get_query_results(self) -> pd.DataFrame:
-        """Fethces the query results from S3 and resturns them in pandas's DataFrame object.
+        """Fethces the current query results and resturns them in pandas's DataFrame object.
 
         Returns:
             pd.DataFrame:
         """
         try:
-            response = (
-                self._resource.Bucket(self._bucket)
-                .Object(key=self._folder + self._execution_id + ".csv")
-                .get()
-            )
-            data = pd.read_csv(io.BytesIO(response["Body"].read()), encoding="utf8")
-            return data
+            return self._handle.result(timeout=0)
         except Exception as e:
             self._logger.error(
-                f"Got the following error when trying to fetch data from S3: {e}"
+                f"Got the following error when trying to fetch the query results: {e}"
             )
             return None
 
+    @property
     def query_id(self) -> str:
-        """A property for getting execution id.
+        """A property for getting execution id of the current query.
 
         Returns:
-            (int): If succeeded returns the execution id, else returns None.
+            (str): If succeeded returns the execution id, else returns None.
         """
-        if self._execution_id:
-            return self._execution_id
+        if self._handle:
+            return self._handle.query_id
         else:
             return None
@@ -1,23 +1,53 @@
+import argparse
 import logging
 from analytics.data_analysis.vehicle_data import VehicleData
+from analytics.data_analysis.profiler import RunProfiler
 
 Logger = logging.getLogger("Analytics")
 
 
+def parse_args() -> argparse.Namespace:
+    """Parses the command line arguments.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(prog="python -m analytics.data_analysis")
+    parser.add_argument(
+        "--profile", action="store_true", help="Measure each phase of the run."
+    )
+    parser.add_argument(
+        "--profile-deep",
+        action="store_true",
+        help="Also capture cProfile and tracemalloc snapshots.",
+    )
+    parser.add_argument(
+        "--profile-output", help="A path to write the profile report (JSON) to."
+    )
+    return parser.parse_args()
+
+
 def main() -> int:
     """The initial main function to launch the progeam.
 
     Returns:
         (int): 0 on success, -1 on failure.
     """
+    args = parse_args()
     try:
         analytics = VehicleData(
             "sensor_data", "s3://erez-test-bucket-me/reports/output/"
         )
+        if args.profile or args.profile_deep or args.profile_output:
+            analytics.profiler = RunProfiler(
+                enabled=True, deep=args.profile_deep, output=args.profile_output
+            )
         if analytics.run():
             print(analytics.results)
         else:
             Logger.error("Failsed to execute query!")
+        if analytics.profiler.enabled and not analytics.profiler.output:
+            print(analytics.profiler.dump())
         return 0
     except Exception as e:
         Logger.error(f"While trying to query data, got the followig exception: {e} .")
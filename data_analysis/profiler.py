@@ -0,0 +1,145 @@
+import cProfile
+from contextlib import contextmanager
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+PROFILE_TOP_FUNCTIONS = 20
+PROFILE_TOP_ALLOCATIONS = 10
+
+
+class RunProfiler:
+    """Measures the wall clock and CPU time of each phase of a report run.
+    In deep mode, each phase is also profiled with cProfile and the allocations
+    of the phases which trace memory are captured with tracemalloc.
+    The report is a sorted JSON document, so reports of different versions can be diffed.
+    """
+
+    def __init__(
+        self, enabled: bool = False, deep: bool = False, output: str = None
+    ) -> None:
+        """Ctor.
+
+        Args:
+            enabled (bool, optional): Whether to profile the runs. Defaults to False.
+            deep (bool, optional): Whether to also capture cProfile and tracemalloc
+                snapshots. Defaults to False.
+            output (str, optional): A path to write the report to after each run.
+                Defaults to None.
+        """
+        self.enabled = enabled or deep
+        self.deep = deep
+        self.output = output
+        self._phases = []
+
+    @classmethod
+    def from_env(cls) -> "RunProfiler":
+        """Creates a profiler according to the following environment variables:
+        ANALYTICS_PROFILE - "1" to enable the profiling, "deep" to also capture
+            cProfile and tracemalloc snapshots.
+        ANALYTICS_PROFILE_OUTPUT - A path to write the report to after each run.
+
+        Returns:
+            RunProfiler: The profiler.
+        """
+        mode = os.getenv("ANALYTICS_PROFILE", "").lower()
+        return cls(
+            enabled=mode in ("1", "true", "deep"),
+            deep=mode == "deep",
+            output=os.getenv("ANALYTICS_PROFILE_OUTPUT"),
+        )
+
+    def reset(self):
+        """Drops the phases which were measured so far."""
+        self._phases = []
+
+    @contextmanager
+    def phase(self, name: str, trace_memory: bool = False):
+        """A context manager which measures the phase executed inside it.
+
+        Args:
+            name (str): The name of the phase.
+            trace_memory (bool, optional): Whether to capture the peak allocations
+                of the phase (in deep mode only). Defaults to False.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        profile = cProfile.Profile() if self.deep else None
+        trace_memory = self.deep and trace_memory and not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            record = {
+                "name": name,
+                "wall_secs": round(time.perf_counter() - wall_start, 6),
+                "cpu_secs": round(time.process_time() - cpu_start, 6),
+            }
+            if profile:
+                record["cprofile"] = self._top_functions(profile)
+            if trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                record["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                record["top_allocations"] = [
+                    str(stat)
+                    for stat in snapshot.statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]
+                ]
+            self._phases.append(record)
+
+    @staticmethod
+    def _top_functions(profile: cProfile.Profile) -> list:
+        """Formats the functions with the highest cumulative time of a profile.
+
+        Args:
+            profile (cProfile.Profile): The profile.
+
+        Returns:
+            list: A line per function.
+        """
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        lines = stream.getvalue().splitlines()
+        # Skips the pstats header, up to the columns titles line.
+        for i, line in enumerate(lines):
+            if line.lstrip().startswith("ncalls"):
+                lines = lines[i + 1 :]
+                break
+        return [line.strip() for line in lines if line.strip()]
+
+    @property
+    def report(self) -> dict:
+        """Returns the profile report of the measured phases.
+
+        Returns:
+            dict: The phases and the total wall clock and CPU time.
+        """
+        return {
+            "phases": self._phases,
+            "total_wall_secs": round(sum(p["wall_secs"] for p in self._phases), 6),
+            "total_cpu_secs": round(sum(p["cpu_secs"] for p in self._phases), 6),
+        }
+
+    def dump(self) -> str:
+        """Formats the report as JSON and writes it to the output path (if set).
+
+        Returns:
+            str: The report in JSON format.
+        """
+        report = json.dumps(self.report, indent=2, sort_keys=True)
+        if self.output:
+            with open(self.output, "w") as fh:
+                fh.write(report + "\n")
+        return report
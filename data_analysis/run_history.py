@@ -0,0 +1,176 @@
+from datetime import datetime, timezone
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+import pandas as pd
+
+INDEX_FILE = "index.jsonl"
+TRUE_DETECTIONS_METRIC = "true_detections"
+# The time range of a run, which is recorded in the index but is not part of the
+# config key, so the runs of a rolling window (e.g. last week) form a single trend.
+# The other partition filters (e.g. region) do remain a part of the key.
+WINDOW_KEYS = ("time_range",)
+
+
+class RunHistory:
+    """An append-only local store of the results of the report runs.
+    Each run is written as a parquet segment of (run_time, run_id, vehicle_type,
+    bin, metric, value) rows, inside the directory of its config key and named by
+    its run time. So the runs of a config are found by listing a single directory,
+    already sorted by time, without touching athena.
+    Every run is also recorded, together with its full config (including its time
+    range), in an index file.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Ctor.
+
+        Args:
+            path (str): The directory of the store, created if missing.
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def config_key(config: dict) -> str:
+        """Calculates the key which identifies the trend of the given config,
+        that is the config without its time range (see WINDOW_KEYS).
+
+        Args:
+            config (dict): The run config (boundaries, exclusions, database, time range...).
+
+        Returns:
+            str: The config key.
+        """
+        trend = {key: value for key, value in config.items() if key not in WINDOW_KEYS}
+        canonical = json.dumps(trend, sort_keys=True, default=str)
+        return hashlib.sha1(canonical.encode("utf8")).hexdigest()[:16]
+
+    @staticmethod
+    def _to_rows(results: pd.DataFrame) -> pd.DataFrame:
+        """Converts the results of a run to (vehicle_type, bin, metric, value) rows.
+
+        Args:
+            results (pd.DataFrame): Either the true detections percentage per bin
+                (a column per bin), or the metrics indexed by (vehicle_type, bin).
+
+        Returns:
+            pd.DataFrame: The results rows.
+        """
+        if isinstance(results.index, pd.MultiIndex):
+            rows = results.reset_index().melt(
+                id_vars=["vehicle_type", "bin"], var_name="metric"
+            )
+        else:
+            rows = results.melt(id_vars="vehicle_type", var_name="bin").assign(
+                metric=TRUE_DETECTIONS_METRIC
+            )
+        rows["bin"] = rows["bin"].astype(str)
+        rows["value"] = rows["value"].astype(float)
+        return rows[["vehicle_type", "bin", "metric", "value"]]
+
+    def append(
+        self, config: dict, results: pd.DataFrame, run_time: datetime = None
+    ) -> str:
+        """Records the results of a run.
+
+        Args:
+            config (dict): The run config.
+            results (pd.DataFrame): The run results.
+            run_time (datetime, optional): The time of the run (naive times are local).
+                Defaults to None, which means now.
+
+        Returns:
+            str: The run id.
+        """
+        run_id = uuid.uuid4().hex
+        run_time = (run_time or datetime.now(timezone.utc)).astimezone(timezone.utc)
+        key = self.config_key(config)
+        rows = self._to_rows(results)
+        rows.insert(0, "run_id", run_id)
+        rows.insert(0, "run_time", pd.Timestamp(run_time))
+
+        directory = os.path.join(self._path, key)
+        os.makedirs(directory, exist_ok=True)
+        segment = f"{run_time.strftime('%Y%m%dT%H%M%S%f')}_{run_id}.parquet"
+        rows.to_parquet(os.path.join(directory, segment), index=False)
+        entry = {
+            "run_id": run_id,
+            "run_time": run_time.isoformat(),
+            "config_key": key,
+            "config": config,
+            "segment": os.path.join(key, segment),
+        }
+        with self._lock:
+            with open(os.path.join(self._path, INDEX_FILE), "a") as fh:
+                fh.write(json.dumps(entry, sort_keys=True, default=str) + "\n")
+        return run_id
+
+    def runs(self) -> pd.DataFrame:
+        """Returns the index of all the recorded runs.
+
+        Returns:
+            pd.DataFrame: A row per run with its id, time, config key and config.
+        """
+        index = os.path.join(self._path, INDEX_FILE)
+        if not os.path.exists(index):
+            return pd.DataFrame(
+                columns=["run_id", "run_time", "config_key", "config", "segment"]
+            )
+        return pd.read_json(index, lines=True)
+
+    def query(
+        self,
+        config: dict,
+        vehicle_type: str = None,
+        bin: str = None,
+        metric: str = None,
+        last_runs: int = None,
+        since: datetime = None,
+    ) -> pd.DataFrame:
+        """Returns the recorded results of the runs of the given config (whatever
+        their time range was), e.g.
+        query(config, vehicle_type="truck", bin="40_49", last_runs=90).
+
+        Args:
+            config (dict): The run config.
+            vehicle_type (str, optional): Filter by vehicle type. Defaults to None.
+            bin (str, optional): Filter by bin name. Defaults to None.
+            metric (str, optional): Filter by metric. Defaults to None.
+            last_runs (int, optional): Only the last runs. Defaults to None.
+            since (datetime, optional): Only the runs since that time. Defaults to None.
+
+        Returns:
+            pd.DataFrame: The (run_time, run_id, vehicle_type, bin, metric, value) rows,
+                sorted by run time.
+        """
+        directory = os.path.join(self._path, self.config_key(config))
+        segments = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+        if since is not None:
+            since = since.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+            segments = [segment for segment in segments if segment >= since]
+        if last_runs is not None:
+            segments = segments[-last_runs:] if last_runs > 0 else []
+        if not segments:
+            return pd.DataFrame(
+                columns=["run_time", "run_id", "vehicle_type", "bin", "metric", "value"]
+            )
+
+        filters = [
+            (column, "==", value)
+            for column, value in (
+                ("vehicle_type", vehicle_type),
+                ("bin", bin),
+                ("metric", metric),
+            )
+            if value is not None
+        ]
+        data = pd.read_parquet(
+            [os.path.join(directory, segment) for segment in segments],
+            filters=filters or None,
+        )
+        return data.sort_values("run_time", kind="stable").reset_index(drop=True)
@@ -1,28 +1,83 @@
+from collections import deque
+from datetime import date
+import json
 import os
-from logging import getLogger
 import time
+from logging import getLogger
 
 import pandas as pd
 
-from analytics.aws.athena_client import AthenClient
-from analytics.sql.query_builder import TrueDetectionsQuery
+from analytics.aws.athena_client import AthenClient, QueryHandle
+from analytics.data_analysis.profiler import RunProfiler
+from analytics.data_analysis.run_history import RunHistory
+from analytics.sql.query_builder import (
+    CountedDistancesQuery,
+    TrueDetectionsQuery,
+    MetricsQuery,
+    RollupQuery,
+    MissingPartitionsQuery,
+    PARTITION_COLUMN,
+    MAX_PARTITIONS_PER_WRITE,
+    OUT_OF_RANGE_DIST,
+)
 
 
 class VehicleData:
     """The main class for querying vehicle data from athena."""
 
     def __init__(self, db: str, s3_results_uri) -> None:
+        self._db = db
         self._vehicles = set()
         self._min = 1
         self._max = 100
         self._step = 10
+        self._metrics = []
+        self._partition_filters = {}
+        self._rollup = None
+        self._partition_column = PARTITION_COLUMN
         self._logger = getLogger(self.__class__.__name__)
         self._athena = AthenClient(db, s3_results_uri)
-        self.query_builder = TrueDetectionsQuery(
-            self._vehicles, self._min, self._max, self._step
-        )
+        self._profiler = None
+        self.profiler = RunProfiler.from_env()
+        self._history = None
+        self._counts_cache = None
+        self._counts_max_age = None
+        self._update_query_builder()
         self._results = None
 
+    @property
+    def profiler(self) -> RunProfiler:
+        """Returns the profiler of the runs.
+
+        Returns:
+            RunProfiler: The profiler.
+        """
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler: RunProfiler):
+        """Sets the profiler of the runs, which also measures the download and
+        the decoding of the results by the athena client.
+
+        Args:
+            profiler (RunProfiler): The profiler.
+        """
+        self._profiler = profiler
+        self._athena.profiler = profiler
+
+    def _update_query_builder(self):
+        """Recreates the query builder according to the current settings."""
+        builder = MetricsQuery if self._metrics else TrueDetectionsQuery
+        self.query_builder = builder(
+            self._vehicles,
+            self._min,
+            self._max,
+            self._step,
+            rollup_table=self._rollup,
+            metrics=self._metrics,
+            partition_filters=self._partition_filters,
+        )
+
     def exclude_vehicles(self, vehicles: set):
         """Excludes the vehicles specifeid from the results.
 
@@ -30,9 +85,7 @@ class VehicleData:
             vehicles (set): a set of vehicles types.
         """
         self._vehicles |= vehicles
-        self.query_builder = TrueDetectionsQuery(
-            self._vehicles, self._min, self._max, self._step
-        )
+        self._update_query_builder()
 
     def set_boundaries(
         self, min_dist: int = 1, max_dist: int = 100, step_dist: int = 10
@@ -60,37 +113,353 @@ class VehicleData:
         self._min = min_dist
         self._max = max_dist
         self._step = step_dist
-        self.query_builder = TrueDetectionsQuery(
-            self._vehicles, min_dist, max_dist, step_dist
+        self._update_query_builder()
+
+    def set_metrics(self, metrics: list = None):
+        """Sets the metrics to compute per vehicle type and bin instead of
+        the true detections percentage. All the metrics are computed in a single scan
+        and the results are indexed by (vehicle_type, bin).
+
+        Args:
+            metrics (list, optional): A list of MetricSpec. Defaults to None,
+                which means the true detections percentage.
+        """
+        self._metrics = list(metrics or [])
+        self._update_query_builder()
+
+    def set_time_range(
+        self,
+        start: date = None,
+        end: date = None,
+        column: str = PARTITION_COLUMN,
+        time_format: str = "%Y-%m-%d",
+    ):
+        """Restricts the scan to the partitions within the given time range (inclusive),
+        so athena reads only those partitions.
+
+        Args:
+            start (date, optional): The first date (or datetime) to query. Defaults to None.
+            end (date, optional): The last date (or datetime) to query. Defaults to None.
+            column (str, optional): The time partition column. Defaults to PARTITION_COLUMN.
+            time_format (str, optional): The format of the time partition values.
+                Defaults to "%Y-%m-%d".
+
+        Raises:
+            ValueError: In case neither start nor end is given, in case start > end
+                or in case the rollup table is in use and column is not its partition column.
+        """
+        if start is None and end is None:
+            raise ValueError("At least one of start and end should be given.")
+        if start and end and start > end:
+            raise ValueError("start should qualified for: start <= end")
+        self._check_rollup_partitions(self._rollup, self._partition_column, [column])
+        start = start.strftime(time_format) if start else None
+        end = end.strftime(time_format) if end else None
+        self._partition_filters[column] = (start, end)
+        self._update_query_builder()
+
+    def filter_partitions(self, **filters):
+        """Restricts the scan to the given partitions, so athena reads only those partitions.
+        Each filter value might be a single value or a list of values, e.g:
+        filter_partitions(region="eu", sensor=["front", "rear"]).
+
+        Raises:
+            ValueError: In case a filter is an empty list or in case the rollup table is
+                in use and the filters refer to other columns than its partition column.
+        """
+        for column, value in filters.items():
+            if isinstance(value, list) and not value:
+                raise ValueError(f"The partition filter of {column} has no values.")
+        self._check_rollup_partitions(
+            self._rollup, self._partition_column, filters.keys()
         )
+        self._partition_filters.update(filters)
+        self._update_query_builder()
 
-    def run(self):
-        """Sends the Query to athena and wait for results.
+    @staticmethod
+    def _check_rollup_partitions(rollup: str, partition_column: str, columns):
+        """Validates the partition filters can be applied on the rollup table,
+        which is partitioned only by the partition column.
+
+        Args:
+            rollup (str): The name of the rollup table (if in use).
+            partition_column (str): The partition column of the rollup table.
+            columns: The filtered partition columns.
+
+        Raises:
+            ValueError: In case a column is not the rollup partition column.
+        """
+        if rollup and any(column != partition_column for column in columns):
+            raise ValueError(
+                f"The rollup table {rollup} can only be filtered by {partition_column}."
+            )
+
+    def set_history(self, history: RunHistory = None):
+        """Records the results of every successful run, together with its config,
+        in the given run history store.
+
+        Args:
+            history (RunHistory, optional): The store. Defaults to None,
+                which means the results are not recorded.
+        """
+        self._history = history
+
+    def cache_counts(
+        self, enabled: bool = True, max_entries: int = 16, max_age_secs: float = 600
+    ):
+        """Keeps the counts per (vehicle_type, bin) of the previous runs, so a run whose
+        config is subsumed by a previous one is answered locally instead of querying athena.
+        A config is subsumed when it differs only by the excluded vehicles, or by bins which
+        are unions of the previous bins (e.g. a step of 10 instead of 5 over the same range).
+        Only the true detections percentage (no metrics) is answered from the counts.
+        The counts don't include the rows which were added to the table after they were
+        queried, so they are used only up to max_age_secs.
+
+        Args:
+            enabled (bool, optional): Whether to keep the counts. Defaults to True.
+            max_entries (int, optional): The maximal number of previous runs to keep.
+                Defaults to 16.
+            max_age_secs (float, optional): The maximal age of the counts to use.
+                Defaults to 600, None means the counts never expire.
+        """
+        self._counts_cache = deque(maxlen=max_entries) if enabled else None
+        self._counts_max_age = max_age_secs
+
+    @property
+    def config(self) -> dict:
+        """Returns the config which determines the results of a run.
+
+        Returns:
+            dict: The database, boundaries, exclusions, metrics, partition filters
+                and time range.
+        """
+        return {
+            "database": self._db,
+            "min_dist": self._min,
+            "max_dist": self._max,
+            "step_dist": self._step,
+            "exclude_vehicles": sorted(self._vehicles),
+            "metrics": [metric.model_dump() for metric in self._metrics],
+            "partition_filters": {
+                column: value
+                for column, value in self._partition_filters.items()
+                if not isinstance(value, tuple)
+            },
+            "time_range": {
+                column: list(value)
+                for column, value in self._partition_filters.items()
+                if isinstance(value, tuple)
+            },
+        }
+
+    def use_rollup(self, rollup_table: str, partition_column: str = PARTITION_COLUMN):
+        """Answers the queries from the rollup table instead of scanning the source table.
+        The rollup table should be created with create_rollup and kept up to date
+        with refresh_rollup.
+
+        Args:
+            rollup_table (str): The name of the rollup table.
+            partition_column (str, optional): The partition column of the source table.
+                Defaults to PARTITION_COLUMN.
+
+        Raises:
+            ValueError: In case the partition filters refer to other columns
+                than the partition column.
+        """
+        self._check_rollup_partitions(
+            rollup_table, partition_column, self._partition_filters.keys()
+        )
+        self._rollup = rollup_table
+        self._partition_column = partition_column
+        self._clear_counts_cache()
+        self._update_query_builder()
+
+    def _clear_counts_cache(self):
+        """Drops the counts of the previous runs, e.g. once the rollup table has changed."""
+        if self._counts_cache is not None:
+            self._counts_cache.clear()
+
+    def create_rollup(self) -> bool:
+        """Creates the (empty) rollup table which was set with use_rollup.
+
+        Raises:
+            ValueError: In case no rollup table was set.
+
+        Returns:
+            bool: True in case the table was successfully created, False otherwise.
+        """
+        if not self._rollup:
+            raise ValueError("No rollup table was set, call use_rollup first.")
+        query_builder = RollupQuery(self._rollup, self._partition_column, create=True)
+        query_builder.build_query()
+        return self._execute(query_builder.query, write=True) is not None
+
+    def refresh_rollup(self, partitions: list = None, up_to: str = None) -> bool:
+        """Inserts the aggregated rows of the given partitions into the rollup table.
+        A partition is inserted only once (inserting it again would count its rows twice),
+        which is safe only for closed partitions, which don't receive rows anymore.
+        So by default only the missing partitions up to up_to are inserted, or if not given,
+        all the missing partitions but the newest one, which may still receive rows and is
+        inserted by the first refresh after a newer partition shows up.
+        Note the reports from the rollup table don't include the partitions not inserted yet.
+
+        Args:
+            partitions (list, optional): The partitions to insert, the caller is responsible
+                for them to be closed and missing from the rollup table. Defaults to None,
+                which means the closed partitions which are missing from the rollup table.
+            up_to (str, optional): The last closed partition. Defaults to None, which means
+                all the partitions but the newest one are closed.
+
+        Raises:
+            ValueError: In case no rollup table was set.
+
+        Returns:
+            bool: True in case all the partitions were successfully inserted, False otherwise.
+        """
+        if not self._rollup:
+            raise ValueError("No rollup table was set, call use_rollup first.")
+        if partitions is None:
+            query_builder = MissingPartitionsQuery(
+                self._rollup, self._partition_column, up_to
+            )
+            query_builder.build_query()
+            handle = self._execute(query_builder.query)
+            if handle is None:
+                return False
+            missing = self._fetch(handle)
+            if missing is None:
+                return False
+            partitions = missing[self._partition_column].astype(str).tolist()
+
+        if partitions:
+            # The counts taken from the rollup table don't include the new partitions.
+            self._clear_counts_cache()
+        for i in range(0, len(partitions), MAX_PARTITIONS_PER_WRITE):
+            query_builder = RollupQuery(
+                self._rollup,
+                self._partition_column,
+                partitions[i : i + MAX_PARTITIONS_PER_WRITE],
+            )
+            query_builder.build_query()
+            if self._execute(query_builder.query, write=True) is None:
+                self._logger.error(
+                    f"Failed to insert partitions {partitions[i]} and onwards into the rollup table."
+                )
+                return False
+        return True
+
+    def _execute(
+        self, query: str, coalesce: bool = False, write: bool = False
+    ) -> QueryHandle:
+        """Sends the query to athena and waits for it to complete.
         The function uses following environment variables:
         QUERY_TIMEOUT_SECS - To determine how long to wait for query to complete.
+        WRITE_QUERY_TIMEOUT_SECS - To determine how long to wait for a write query
+            (CREATE TABLE AS / INSERT INTO) to complete, by default there is no limit.
         QUERY_STATUS_CHECK_INTERVAL_SECS - To set the interval betwees status check of the query.
+        A write query which times out is left running: athena doesn't roll back a cancelled
+        INSERT INTO, so cancelling it might leave part of its rows in the table.
+
+        Args:
+            query (str): The SQL query.
+            coalesce (bool, optional): Whether to share the execution of an identical
+                query which is already in flight. Defaults to False.
+            write (bool, optional): Whether the query writes into a table. Defaults to False.
 
         Returns:
-            bool: True in case query was successfully executed, False otherwise.
+            QueryHandle: The handle to the query in case it was successfully executed, None otherwise.
         """
-        res = False
-        timeout = int(os.getenv("QUERY_TIMEOUT_SECS", "5"))
+        if write:
+            timeout = os.getenv("WRITE_QUERY_TIMEOUT_SECS")
+            timeout = float(timeout) if timeout else None
+        else:
+            timeout = int(os.getenv("QUERY_TIMEOUT_SECS", "5"))
         interval = float(os.getenv("QUERY_STATUS_CHECK_INTERVAL_SECS", "0.1"))
-        self.query_builder.build_query()
-        start_time = time.perf_counter()
-        self._athena.execute(self.query_builder.query)
-        while self._athena.status != "SUCCEEDED":
-            time.sleep(interval)
-            if time.perf_counter() - start_time > timeout:
+        with self.profiler.phase("submit"):
+            handle = self._athena.execute(query, coalesce)
+        try:
+            with self.profiler.phase("wait"):
+                status = handle.wait(timeout, interval)
+        except TimeoutError as e:
+            self._logger.error(str(e))
+            if write:
+                self._logger.error(
+                    f"Write query {handle.query_id} is left running, it should complete "
+                    "before the rollup table is refreshed again."
+                )
+                return None
+            # Stops the abandoned scan, unless other callers still share it.
+            try:
+                self._athena.abandon(handle)
+            except Exception as e:
                 self._logger.error(
-                    f"The time limit of {timeout} seconds has exceeded for this query."
+                    f"Got the following error when trying to cancel query {handle.query_id}: {e}"
                 )
-                break
+            return None
+
+        if status != "SUCCEEDED":
+            self._logger.error(f"Query {handle.query_id} has {status.lower()}.")
+            return None
+        return handle
+
+    def _fetch(self, handle: QueryHandle) -> pd.DataFrame:
+        """Fetches the results of a query which was successfully executed.
 
-        if self._athena.status == "SUCCEEDED":
-            self._results = self._athena.get_query_results()
+        Args:
+            handle (QueryHandle): The handle to the query.
+
+        Returns:
+            pd.DataFrame: The query results, None in case of failure.
+        """
+        try:
+            return handle.result(timeout=0)
+        except Exception as e:
+            self._logger.error(
+                f"Got the following error when trying to fetch the query results: {e}"
+            )
+            return None
+
+    def run(self):
+        """Sends the Query to athena and wait for results.
+        See _execute for the environment variables in use.
+        When profiling is enabled (see RunProfiler.from_env), each phase of the run
+        is measured and the profile report is written to the profiler output.
+
+        Returns:
+            bool: True in case query was successfully executed, False otherwise.
+        """
+        self.profiler.reset()
+        if self._counts_cache is not None and not self._metrics:
+            res = self._run_from_counts()
+        else:
+            res = self._run_query()
+
+        if res and self._history and self._results is not None:
+            with self.profiler.phase("record"):
+                self._record_history()
+        if self.profiler.enabled:
+            self._logger.info(f"Run profile:\n{self.profiler.dump()}")
+        return res
+
+    def _run_query(self) -> bool:
+        """Sends the query of the query builder to athena and fetches its results.
+
+        Returns:
+            bool: True in case query was successfully executed, False otherwise.
+        """
+        res = False
+        with self.profiler.phase("build"):
+            self.query_builder.build_query()
+        # Identical reports which are requested at the same time share a single scan.
+        handle = self._execute(self.query_builder.query, coalesce=True)
+        if handle:
+            # The client measures the download and the decoding of the results.
+            self._results = self._fetch(handle)
+            if self._metrics and self._results is not None:
+                with self.profiler.phase("derive"):
+                    self._results = self._index_by_bin(self._results)
             self._logger.info(
-                f"Successfully retrived query_id: {self._athena._execution_id} results."
+                f"Successfully retrived query_id: {handle.query_id} results."
             )
             res = True
         else:
@@ -98,6 +467,156 @@ class VehicleData:
 
         return res
 
+    def _run_from_counts(self) -> bool:
+        """Derives the true detections percentage from the counts per (vehicle_type, bin)
+        of a previous run which subsumes the current config. In case there is no such run,
+        the counts are queried from athena (for all the vehicles) and kept for the next runs.
+
+        Returns:
+            bool: True in case the results were successfully derived, False otherwise.
+        """
+        scope = self._counts_scope()
+        bounds = (self._min, self._max, self._step)
+        now = time.monotonic()
+        counts = next(
+            (
+                cached
+                for cached_scope, cached_bounds, cached, cached_at in reversed(
+                    self._counts_cache
+                )
+                if cached_scope == scope
+                and self._subsumes(cached_bounds, bounds)
+                and (self._counts_max_age is None or now - cached_at <= self._counts_max_age)
+            ),
+            None,
+        )
+        if counts is not None:
+            self._logger.info("Answering the query from the counts of a previous run.")
+        else:
+            query_builder = CountedDistancesQuery(
+                set(),
+                self._min,
+                self._max,
+                self._step,
+                rollup_table=self._rollup,
+                partition_filters=self._partition_filters,
+            )
+            with self.profiler.phase("build"):
+                query_builder.build_query()
+            handle = self._execute(query_builder.query, coalesce=True)
+            if not handle:
+                self._logger.error("Failed to retrive query results.")
+                return False
+            counts = self._fetch(handle)
+            if counts is None:
+                return False
+            self._logger.info(
+                f"Successfully retrived query_id: {handle.query_id} results."
+            )
+            self._counts_cache.append((scope, bounds, counts, time.monotonic()))
+
+        with self.profiler.phase("derive"):
+            self._results = self._true_detections(counts)
+        return True
+
+    def _counts_scope(self) -> str:
+        """Returns the part of the config which the counts depend on,
+        except of the boundaries.
+
+        Returns:
+            str: The scope in JSON format.
+        """
+        config = self.config
+        scope = {
+            "database": config["database"],
+            "partition_filters": config["partition_filters"],
+            "time_range": config["time_range"],
+            "rollup": self._rollup,
+        }
+        return json.dumps(scope, sort_keys=True, default=str)
+
+    @staticmethod
+    def _subsumes(cached: tuple, bounds: tuple) -> bool:
+        """Checks whether each of the bins of the given boundaries is a union
+        of the cached bins.
+
+        Args:
+            cached (tuple): The (min_dist, max_dist, step_dist) of the cached counts.
+            bounds (tuple): The (min_dist, max_dist, step_dist) to check.
+
+        Returns:
+            bool: True in case the bins can be derived from the cached bins.
+        """
+        cached_min, cached_max, cached_step = cached
+        min_dist, max_dist, step_dist = bounds
+        if min_dist < cached_min or (min_dist - cached_min) % cached_step:
+            return False
+        if step_dist % cached_step:
+            return False
+        cached_last = cached_min + (cached_max - cached_min) // cached_step * cached_step
+        last = min_dist + (max_dist - min_dist) // step_dist * step_dist
+        return last + step_dist <= cached_last + cached_step
+
+    def _true_detections(self, counts: pd.DataFrame) -> pd.DataFrame:
+        """Merges the counts per (vehicle_type, dist) into the current bins, drops the
+        excluded vehicles and calculates the true detections percentage per bin,
+        in the same format as TrueDetectionsQuery.
+
+        Args:
+            counts (pd.DataFrame): The number_of_dist and number_of_detections
+                per vehicle_type and dist.
+
+        Returns:
+            pd.DataFrame: The true detections percentage, a column per bin.
+        """
+        starts = list(range(self._min, self._max + 1, self._step))
+        counts = counts[
+            counts["vehicle_type"].notna()
+            & ~counts["vehicle_type"].isin(self._vehicles | {"ignore"})
+        ]
+        bin_start = self._min + (counts["dist"] - self._min) // self._step * self._step
+        inside = (counts["dist"] != OUT_OF_RANGE_DIST) & (counts["dist"] >= self._min)
+        inside &= bin_start <= starts[-1]
+        merged = (
+            counts[inside]
+            .assign(dist=bin_start[inside])
+            .groupby(["vehicle_type", "dist"])[["number_of_dist", "number_of_detections"]]
+            .sum()
+        )
+        percentage = 100.0 * merged["number_of_detections"] / merged["number_of_dist"]
+        results = percentage.unstack("dist").reindex(
+            index=sorted(counts["vehicle_type"].unique()), columns=starts
+        )
+        results.columns = [f"{i}_{i + self._step - 1}" for i in starts]
+        results.index.name = "vehicle_type"
+        return results.reset_index()
+
+    def _record_history(self):
+        """Records the results in the run history store, a failure is only logged."""
+        try:
+            self._history.append(self.config, self._results)
+        except Exception as e:
+            self._logger.error(
+                f"Got the following error when trying to record the run history: {e}"
+            )
+
+    def _index_by_bin(self, data: pd.DataFrame) -> pd.DataFrame:
+        """Replaces the bin first distance with the bin name and indexes
+        the metrics by (vehicle_type, bin).
+
+        Args:
+            data (pd.DataFrame): The metrics per vehicle_type and dist.
+
+        Returns:
+            pd.DataFrame: The metrics indexed by (vehicle_type, bin).
+        """
+        bins = data["dist"].astype(str) + "_" + (data["dist"] + self._step - 1).astype(str)
+        return (
+            data.drop(columns="dist")
+            .assign(bin=bins)
+            .set_index(["vehicle_type", "bin"])
+        )
+
     @property
     def results(self) -> pd.DataFrame:
         """Return the query results in pandas DataFrame format.
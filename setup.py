@@ -6,7 +6,8 @@ with open("README.md", "r") as fh:
 requirements = [
     "boto3==1.34.53",
     "pandas==2.0.3",
-    "pydantic==2.6.3"
+    "pydantic==2.6.3",
+    "pyarrow==12.0.1"
 ]
 
 
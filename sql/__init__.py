@@ -1 +1,9 @@
-from .query_builder import RoundedDistanceQuery, CountedDistancesQuery, TrueDetectionsQuery
\ No newline at end of file
+from .query_builder import (
+    RoundedDistanceQuery,
+    CountedDistancesQuery,
+    TrueDetectionsQuery,
+    MetricsQuery,
+    MetricSpec,
+    RollupQuery,
+    MissingPartitionsQuery,
+)
\ No newline at end of file
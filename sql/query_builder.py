@@ -1,4 +1,8 @@
 from abc import ABC, abstractmethod
+from typing import Literal
+
+from pydantic import BaseModel
+
 from analytics.sql.sql_clause import (
     SelectClause,
     FromClause,
@@ -10,9 +14,93 @@ from analytics.sql.sql_clause import (
     CaseCaluse,
     ConditionExpression,
     ConditionBetweenExpression,
+    ConditionInExpression,
     SubQueryExpression,
+    CreateTableAsClause,
+    InsertIntoClause,
 )
 
+SOURCE_TABLE = "src"
+PARTITION_COLUMN = "dt"
+# Athena limits the number of partitions a single CTAS / INSERT INTO query can write.
+MAX_PARTITIONS_PER_WRITE = 100
+# The dist of the distances outside of the bins, the bins start at min_dist >= 0.
+OUT_OF_RANGE_DIST = -1
+# The metrics (func, field) which can be computed from the rollup table,
+# mapped to their equivalent over the rollup columns.
+ROLLUP_METRICS = {
+    ("count", "*"): ("sum", "number_of_rows"),
+    ("count", "dist"): ("sum", "number_of_rows"),
+    ("count", "distance"): ("sum", "number_of_rows"),
+    ("count_if", "detection"): ("sum", "number_of_detections"),
+    ("sum", "distance"): ("sum", "distance_meter * number_of_rows"),
+    ("min", "distance"): ("min", "distance_meter"),
+    ("max", "distance"): ("max", "distance_meter"),
+    ("avg", "distance"): ("avg", "distance_meter"),
+}
+
+
+def _literal(value) -> str:
+    """Formats a value as SQL literal.
+
+    Args:
+        value: The value to format.
+
+    Returns:
+        str: The literal, strings are quoted.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    value = str(value).replace("'", "''")
+    return f"'{value}'"
+
+
+class MetricSpec(BaseModel):
+    """Describes a metric to compute per vehicle type and bin
+    with one of the SelectClause aggregates.
+    """
+
+    name: str
+    func: Literal["count", "count_if", "sum", "avg", "min", "max"]
+    field: str
+
+    def apply(self, select: SelectClause, rollup: bool = False):
+        """Adds the metric aggregation to the SELECT clause.
+
+        Args:
+            select (SelectClause): The SELECT clause to add the metric to.
+            rollup (bool, optional): Whether the metric is computed from the rollup table.
+                Defaults to False.
+
+        Raises:
+            ValueError: In case the metric can not be computed from the rollup table.
+        """
+        func, field = self.func, self.field
+        alias = AsClause(f'"{self.name}"')
+        if rollup:
+            if (func, field) not in ROLLUP_METRICS:
+                raise ValueError(
+                    f"The metric {func}({field}) can not be computed from the rollup table."
+                )
+            func, field = ROLLUP_METRICS[(func, field)]
+            if func == "avg":
+                # The rollup rows are weighted by the number of raw rows they represent.
+                # 1.0E0 is a double, a plain 1.0 is a decimal(2, 1) which rounds the result.
+                alias.build()
+                select.fields.append(
+                    f"1.0E0 * sum({field} * number_of_rows) / sum(number_of_rows) {alias.clause}"
+                )
+                return
+        aggregates = {
+            "count": select.count_aggr,
+            "count_if": select.count_if_aggr,
+            "sum": select.sum_aggr,
+            "avg": select.averge_aggr,
+            "min": select.min_aggr,
+            "max": select.max_aggr,
+        }
+        aggregates[func](field, alias)
+
 
 class QueryBuilder(ABC):
     """A base class for building SQL queries."""
@@ -23,12 +111,18 @@ class QueryBuilder(ABC):
         min_dist: int = 1,
         max_dist: int = 100,
         step_dist: int = 10,
+        rollup_table: str = None,
+        metrics: list = None,
+        partition_filters: dict = None,
     ) -> None:
         self._query = None
         self._vehicles = exclude_vehicles
         self._min = min_dist
         self._max = max_dist
         self._step = step_dist
+        self._rollup = rollup_table
+        self._metrics = metrics or []
+        self._partition_filters = partition_filters or {}
 
     @abstractmethod
     def build_select(self) -> str:
@@ -70,6 +164,74 @@ class QueryBuilder(ABC):
         """
         return ""
 
+    def _subquery(self, builder: type) -> str:
+        """Builds a query of the given builder type with the same settings
+        and encapsulates it inside parentheses.
+
+        Args:
+            builder (type): The QueryBuilder derived class to build.
+
+        Returns:
+            str: The (subquery).
+        """
+        nested = builder(
+            self._vehicles,
+            self._min,
+            self._max,
+            self._step,
+            rollup_table=self._rollup,
+            metrics=self._metrics,
+            partition_filters=self._partition_filters,
+        )
+        nested.build_query()
+        return SubQueryExpression(subquery=nested.query).expression
+
+    def _filter_partitions(self, where: WhereClause):
+        """Adds the partition filters to the WHERE clause. The filters compare the
+        partition columns directly to literals, which is the form athena needs for
+        partition pruning and partition projection.
+        A filter value might be a single value, a list of values or a (start, end) range.
+
+        Args:
+            where (WhereClause): The WHERE clause to add the conditions to.
+        """
+        for column, value in self._partition_filters.items():
+            if isinstance(value, tuple):
+                start, end = value
+                for operator, limit in ((">=", start), ("<=", end)):
+                    if limit is not None:
+                        condition = ConditionExpression(
+                            variable=column, operator=operator, value=_literal(limit)
+                        )
+                        where.and_condition(condition.expression)
+            elif isinstance(value, list):
+                condition = ConditionInExpression(
+                    variable=column, values=[_literal(item) for item in value]
+                )
+                where.and_condition(condition.expression)
+            else:
+                condition = ConditionExpression(
+                    variable=column, operator="=", value=_literal(value)
+                )
+                where.and_condition(condition.expression)
+
+    def _exclude_vehicles(self, where: WhereClause):
+        """Adds the conditions which exclude the ignored and the excluded
+        vehicles to the WHERE clause.
+
+        Args:
+            where (WhereClause): The WHERE clause to add the conditions to.
+        """
+        condition = ConditionExpression(
+            variable="vehicle_type", operator="!=", value="'ignore'"
+        )
+        where.and_condition(condition.expression)
+        for vehicle in self._vehicles:
+            condition = ConditionExpression(
+                variable="vehicle_type", operator="!=", value=f"'{vehicle}'"
+            )
+            where.and_condition(condition.expression)
+
     @property
     def query(self) -> str:
         """Returns the actual query.
@@ -95,6 +257,8 @@ class QueryBuilder(ABC):
 class RoundedDistanceQuery(QueryBuilder):
     """A class which implements a query which returns the distances
     rounded to bin first distance.
+    When a rollup table is set, the (already aggregated) rollup rows are
+    rounded instead of the raw rows of the source table.
     """
 
     def build_select(self):
@@ -103,19 +267,32 @@ class RoundedDistanceQuery(QueryBuilder):
         Returns:
             str: The SELECT clause.
         """
+        distance = "distance_meter" if self._rollup else "distance"
         option = OptionCluase()
         for i in range(self._min, self._max + 1, self._step):
             condition = ConditionBetweenExpression(
-                variable="distance", min_value=i, max_value=i + self._step - 1
+                variable=distance, min_value=i, max_value=i + self._step - 1
             )
             option.add_option(condition.expression, i)
-        option.add_alternative(0)
+        option.add_alternative(OUT_OF_RANGE_DIST)
         dist_alias = AsClause("dist")
         option.end_option(dist_alias)
         case = CaseCaluse()
         case.add_case(option)
         case.build()
-        select = SelectClause(["vehicle_type", "detection", "distance", case.clause])
+        if self._rollup:
+            fields = [
+                "vehicle_type",
+                "distance_meter",
+                "number_of_rows",
+                "number_of_detections",
+            ]
+        elif self._metrics:
+            # The metrics might refer to any of the source table columns.
+            fields = ["*"]
+        else:
+            fields = ["vehicle_type", "detection", "distance"]
+        select = SelectClause(fields + [case.clause])
         select.build()
         return select.clause
 
@@ -125,10 +302,24 @@ class RoundedDistanceQuery(QueryBuilder):
         Returns:
             str: The FROM clause.
         """
-        fromc = FromClause("src")
+        fromc = FromClause(self._rollup or SOURCE_TABLE)
         fromc.build()
         return fromc.clause
 
+    def build_where(self) -> str:
+        """A function for building the WHERE clause which restricts
+        the table scan to the filtered partitions.
+
+        Returns:
+            str: The WHERE clause.
+        """
+        where = WhereClause()
+        self._filter_partitions(where)
+        if not where.conditions:
+            return ""
+        where.build()
+        return where.clause
+
 
 class CountedDistancesQuery(QueryBuilder):
     """Builds the query which count the number of rows for
@@ -143,9 +334,13 @@ class CountedDistancesQuery(QueryBuilder):
         """
         select = SelectClause(["vehicle_type", "dist"])
         dist_alias = AsClause("number_of_dist")
-        select.count_aggr("dist", dist_alias)
         detections_alias = AsClause("number_of_detections")
-        select.count_if_aggr("detection", detections_alias)
+        if self._rollup:
+            select.sum_aggr("number_of_rows", dist_alias)
+            select.sum_aggr("number_of_detections", detections_alias)
+        else:
+            select.count_aggr("dist", dist_alias)
+            select.count_if_aggr("detection", detections_alias)
         select.build()
         return select.clause
 
@@ -155,12 +350,7 @@ class CountedDistancesQuery(QueryBuilder):
         Returns:
             str: The FROM clause.
         """
-        rounded_distances = RoundedDistanceQuery(
-            self._vehicles, self._min, self._max, self._step
-        )
-        rounded_distances.build_query()
-        rounded_distances_table = SubQueryExpression(subquery=rounded_distances.query)
-        fromc = FromClause(rounded_distances_table.expression)
+        fromc = FromClause(self._subquery(RoundedDistanceQuery))
         fromc.build()
         return fromc.clause
 
@@ -204,8 +394,9 @@ class TrueDetectionsQuery(QueryBuilder):
             case = CaseCaluse()
             option = OptionCluase()
             condition = ConditionExpression(variable="dist", operator="=", value=f"{i}")
+            # 100.0E0 is a double, a plain 100.0 is a decimal(4, 1) which rounds the result.
             option.add_option(
-                condition.expression, "100.0 * number_of_detections / number_of_dist"
+                condition.expression, "100.0E0 * number_of_detections / number_of_dist"
             )
             option.end_option()
             case.add_case(option)
@@ -221,12 +412,7 @@ class TrueDetectionsQuery(QueryBuilder):
         Returns:
             str: The FROM clause.
         """
-        counted_distances = CountedDistancesQuery(
-            self._vehicles, self._min, self._max, self._step
-        )
-        counted_distances.build_query()
-        counted_distances_table = SubQueryExpression(subquery=counted_distances.query)
-        fromc = FromClause(counted_distances_table.expression)
+        fromc = FromClause(self._subquery(CountedDistancesQuery))
         fromc.build()
         return fromc.clause
 
@@ -237,15 +423,7 @@ class TrueDetectionsQuery(QueryBuilder):
             str: The WHERE clause.
         """
         where = WhereClause()
-        condition = ConditionExpression(
-            variable="vehicle_type", operator="!=", value="'ignore'"
-        )
-        where.and_condition(condition.expression)
-        for vehicle in self._vehicles:
-            condition = ConditionExpression(
-                variable="vehicle_type", operator="!=", value=f"'{vehicle}'"
-            )
-            where.and_condition(condition.expression)
+        self._exclude_vehicles(where)
         where.build()
         return where.clause
 
@@ -268,3 +446,293 @@ class TrueDetectionsQuery(QueryBuilder):
         order = OrderByClause(["vehicle_type"])
         order.build()
         return order.clause
+
+
+class MetricsQuery(QueryBuilder):
+    """Builds the query which calculates all the requested metrics
+    per vehicle type per selected distance (the bins) in a single scan.
+    """
+
+    def build_select(self) -> str:
+        """A function for building the SELECT clause.
+
+        Returns:
+            str: The SELECT clause.
+        """
+        select = SelectClause(["vehicle_type", "dist"])
+        for metric in self._metrics:
+            metric.apply(select, rollup=bool(self._rollup))
+        select.build()
+        return select.clause
+
+    def build_from(self) -> str:
+        """A function for building the FROM clause.
+
+        Returns:
+            str: The FROM clause.
+        """
+        fromc = FromClause(self._subquery(RoundedDistanceQuery))
+        fromc.build()
+        return fromc.clause
+
+    def build_where(self) -> str:
+        """A function for building the WHERE clause which drops the distances
+        outside of the bins and the excluded vehicles.
+
+        Returns:
+            str: The WHERE clause.
+        """
+        where = WhereClause()
+        condition = ConditionExpression(
+            variable="dist", operator="!=", value=str(OUT_OF_RANGE_DIST)
+        )
+        where.and_condition(condition.expression)
+        self._exclude_vehicles(where)
+        where.build()
+        return where.clause
+
+    def build_group_by(self) -> str:
+        """A function for building the GROUP BY clause.
+
+        Returns:
+            str: The GROUP BY clause.
+        """
+        group = GroupByClause(["vehicle_type", "dist"])
+        group.build()
+        return group.clause
+
+    def build_order_by(self) -> str:
+        """A function for building the ORDER BY clause.
+
+        Returns:
+            str: The ORDER BY clause.
+        """
+        order = OrderByClause(["vehicle_type", "dist"])
+        order.build()
+        return order.clause
+
+
+class RollupQuery(QueryBuilder):
+    """Builds the query which maintains the rollup table: the number of rows and
+    detections per partition, vehicle type and distance (in meters) of the source table.
+    The rollup is filled incrementally, partition by partition, and any bin boundaries
+    can later be answered from it by the other builders (see rollup_table).
+    """
+
+    def __init__(
+        self,
+        rollup_table: str,
+        partition_column: str = PARTITION_COLUMN,
+        partitions: list = None,
+        create: bool = False,
+    ) -> None:
+        """Ctor.
+
+        Args:
+            rollup_table (str): The name of the rollup table.
+            partition_column (str, optional): The partition column of the source table.
+                Defaults to PARTITION_COLUMN.
+            partitions (list, optional): The partitions to insert into the rollup table.
+                Defaults to None, which means every partition of the source table.
+            create (bool, optional): Whether to create the (empty) rollup table instead
+                of inserting rows into it. Defaults to False.
+        """
+        super().__init__(set())
+        self._table = rollup_table
+        self._partition_column = partition_column
+        self._partitions = partitions
+        self._create = create
+
+    def _distance_meter(self, alias: AsClause = None) -> str:
+        """Builds the distance_meter expression: the distance when it is a whole meter,
+        NULL otherwise. The bins are BETWEEN whole meters, so a fractional distance never
+        falls in any bin of the source table query, and neither does a NULL distance_meter,
+        while the rollup keeps a single row per vehicle type and meter.
+
+        Args:
+            alias (AsClause, optional): adds aliassing to the expression. Defaults to None.
+
+        Returns:
+            str: The distance_meter expression.
+        """
+        option = OptionCluase()
+        condition = ConditionExpression(
+            variable="distance", operator="=", value="floor(distance)"
+        )
+        option.add_option(condition.expression, "CAST(distance AS bigint)")
+        option.end_option(alias)
+        case = CaseCaluse()
+        case.add_case(option)
+        case.build()
+        return case.clause
+
+    def build_select(self) -> str:
+        """A function for building the SELECT clause.
+
+        Returns:
+            str: The SELECT clause.
+        """
+        select = SelectClause(
+            ["vehicle_type", self._distance_meter(AsClause("distance_meter"))]
+        )
+        select.count_aggr("*", AsClause("number_of_rows"))
+        select.count_if_aggr("detection", AsClause("number_of_detections"))
+        # Athena requires the partition columns to be the last ones.
+        select.fields.append(self._partition_column)
+        select.build()
+        return select.clause
+
+    def build_from(self) -> str:
+        """A function for building the FROM clause.
+
+        Returns:
+            str: The FROM clause.
+        """
+        fromc = FromClause(SOURCE_TABLE)
+        fromc.build()
+        return fromc.clause
+
+    def build_where(self) -> str:
+        """A function for building the WHERE clause which restricts the scan
+        to the partitions to insert.
+
+        Returns:
+            str: The WHERE clause.
+        """
+        if self._create or not self._partitions:
+            return ""
+        condition = ConditionInExpression(
+            variable=self._partition_column,
+            values=[_literal(partition) for partition in self._partitions],
+        )
+        where = WhereClause()
+        where.and_condition(condition.expression)
+        where.build()
+        return where.clause
+
+    def build_group_by(self) -> str:
+        """A function for building the GROUP BY clause.
+
+        Returns:
+            str: The GROUP BY clause.
+        """
+        group = GroupByClause(
+            ["vehicle_type", self._distance_meter(), self._partition_column]
+        )
+        group.build()
+        return group.clause
+
+    def build_query(self):
+        """Generates the aggregation query and prepends it with the CREATE TABLE AS
+        or the INSERT INTO header.
+        """
+        super().build_query()
+        if self._create:
+            header = CreateTableAsClause(
+                self._table,
+                {
+                    "format": "'PARQUET'",
+                    "partitioned_by": f"ARRAY['{self._partition_column}']",
+                },
+            )
+            footer = "\nWITH NO DATA"
+        else:
+            header = InsertIntoClause(self._table)
+            footer = ""
+        header.build()
+        self._query = f"{header.clause}\n{self._query}{footer}"
+
+
+class MissingPartitionsQuery(QueryBuilder):
+    """Builds the query which lists the closed partitions of the source table
+    that were not inserted into the rollup table yet.
+    A partition is closed when it is not after up_to, or when no up_to is given,
+    when it is older than the newest partition (which may still receive rows).
+    """
+
+    def __init__(
+        self,
+        rollup_table: str,
+        partition_column: str = PARTITION_COLUMN,
+        up_to: str = None,
+    ) -> None:
+        """Ctor.
+
+        Args:
+            rollup_table (str): The name of the rollup table.
+            partition_column (str, optional): The partition column of the source table.
+                Defaults to PARTITION_COLUMN.
+            up_to (str, optional): The last closed partition. Defaults to None,
+                which means all the partitions but the newest one.
+        """
+        super().__init__(set())
+        self._table = rollup_table
+        self._partition_column = partition_column
+        self._up_to = up_to
+
+    def build_select(self) -> str:
+        """A function for building the SELECT clause.
+
+        Returns:
+            str: The SELECT clause.
+        """
+        select = SelectClause([f"DISTINCT {self._partition_column}"])
+        select.build()
+        return select.clause
+
+    def build_from(self) -> str:
+        """A function for building the FROM clause.
+
+        Returns:
+            str: The FROM clause.
+        """
+        fromc = FromClause(SOURCE_TABLE)
+        fromc.build()
+        return fromc.clause
+
+    def build_where(self) -> str:
+        """A function for building the WHERE clause.
+
+        Returns:
+            str: The WHERE clause.
+        """
+        rollup_partitions = SelectClause([f"DISTINCT {self._partition_column}"])
+        rollup_partitions.build()
+        rollup_table = FromClause(self._table)
+        rollup_table.build()
+        subquery = SubQueryExpression(
+            subquery=f"{rollup_partitions.clause}\n{rollup_table.clause}"
+        )
+        condition = ConditionExpression(
+            variable=self._partition_column, operator="NOT IN", value=subquery.expression
+        )
+        where = WhereClause()
+        where.and_condition(condition.expression)
+        if self._up_to is not None:
+            closed = ConditionExpression(
+                variable=self._partition_column, operator="<=", value=_literal(self._up_to)
+            )
+        else:
+            newest_partition = SelectClause([f"max({self._partition_column})"])
+            newest_partition.build()
+            source_table = FromClause(SOURCE_TABLE)
+            source_table.build()
+            newest = SubQueryExpression(
+                subquery=f"{newest_partition.clause}\n{source_table.clause}"
+            )
+            closed = ConditionExpression(
+                variable=self._partition_column, operator="<", value=newest.expression
+            )
+        where.and_condition(closed.expression)
+        where.build()
+        return where.clause
+
+    def build_order_by(self) -> str:
+        """A function for building the ORDER BY clause.
+
+        Returns:
+            str: The ORDER BY clause.
+        """
+        order = OrderByClause([self._partition_column])
+        order.build()
+        return order.clause
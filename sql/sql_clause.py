@@ -37,6 +37,23 @@ class ConditionBetweenExpression(BaseModel):
         return f"{self.variable} BETWEEN {self.min_value} AND {self.max_value}"
 
 
+class ConditionInExpression(BaseModel):
+    """A class which represnt an IN expression that might be used inside SQL clauses."""
+
+    variable: str
+    values: list
+
+    @property
+    def expression(self) -> str:
+        """A propery to display the expression in the correct order.
+
+        Returns:
+            str: The full expression.
+        """
+        values = ", ".join(str(value) for value in self.values)
+        return f"{self.variable} IN ({values})"
+
+
 class SubQueryExpression(BaseModel):
     """Encapsulates subquery inside parentheses."""
 
@@ -82,6 +99,51 @@ class AsClause(SqlClause):
         self.clause = f"{self.command} {self.alias}"
 
 
+class CreateTableAsClause(SqlClause):
+    """This class implements the CREATE TABLE AS (CTAS) header of SQL."""
+
+    table: str
+    properties: dict = {}
+
+    def __init__(self, table: str, properties: dict = None) -> None:
+        """Ctor.
+
+        Args:
+            table (str): The name of the table to create.
+            properties (dict, optional): The table properties (e.g. format, partitioned_by)
+                which will be placed inside the WITH clause. Defaults to None.
+        """
+        super().__init__(command="CREATE TABLE", table=table, properties=properties or {})
+
+    def build(self):
+        """Builds the SQL Clause and store it in self.clause."""
+        clause = f"{self.command} {self.table}"
+        if self.properties:
+            properties = ",\n\t".join(
+                f"{key} = {value}" for key, value in self.properties.items()
+            )
+            clause += f"\nWITH (\n\t{properties}\n)"
+        self.clause = f"{clause} AS"
+
+
+class InsertIntoClause(SqlClause):
+    """This class implements the INSERT INTO header of SQL."""
+
+    table: str
+
+    def __init__(self, table: str) -> None:
+        """Ctor.
+
+        Args:
+            table (str): The name of the table to insert the rows into.
+        """
+        super().__init__(command="INSERT INTO", table=table)
+
+    def build(self):
+        """Builds the SQL Clause and store it in self.clause."""
+        self.clause = f"{self.command} {self.table}"
+
+
 class SelectClause(SqlClause):
     """This class implements the SELECT clause of SQL."""
 
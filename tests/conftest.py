@@ -0,0 +1,18 @@
+import importlib.util
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# The repository root is the analytics package itself, register it under its name
+# in case it is not installed.
+if "analytics" not in sys.modules:
+    try:
+        import analytics  # noqa: F401
+    except ImportError:
+        spec = importlib.util.spec_from_file_location(
+            "analytics", ROOT / "__init__.py", submodule_search_locations=[str(ROOT)]
+        )
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["analytics"] = module
+        spec.loader.exec_module(module)
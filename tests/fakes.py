@@ -0,0 +1,59 @@
+import itertools
+
+
+class FakeAthena:
+    """A fake boto3 athena client, the queries never complete unless succeed is set."""
+
+    def __init__(self, succeed: bool = False, results: dict = None) -> None:
+        self.succeed = succeed
+        # The results rows (without the header) of each query, the columns which hold
+        # strings are varchar, the others are integers.
+        # The queries without results return no rows.
+        self.results = results or {}
+        self.started = []
+        self.stopped = []
+        self._ids = itertools.count()
+
+    def start_query_execution(self, QueryString, **kwargs):
+        execution_id = f"q{next(self._ids)}"
+        self.started.append((execution_id, QueryString))
+        return {"QueryExecutionId": execution_id}
+
+    def get_query_execution(self, QueryExecutionId):
+        if QueryExecutionId in self.stopped:
+            state = "CANCELLED"
+        else:
+            state = "SUCCEEDED" if self.succeed else "RUNNING"
+        return {"QueryExecution": {"Status": {"State": state}, "Statistics": {}}}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.stopped.append(QueryExecutionId)
+        return {}
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, QueryExecutionId, **kwargs):
+        query = dict(self.started)[QueryExecutionId]
+        columns, rows = self.results.get(query, ([], []))
+        header = {"Data": [{"VarCharValue": column} for column in columns]}
+        data = [{"Data": [{"VarCharValue": str(value)} for value in row]} for row in rows]
+        types = [
+            "varchar" if any(isinstance(row[i], str) for row in rows) else "integer"
+            for i in range(len(columns))
+        ]
+        metadata = {
+            "ColumnInfo": [
+                {"Name": column, "Type": column_type}
+                for column, column_type in zip(columns, types)
+            ]
+        }
+        return [{"ResultSet": {"ResultSetMetadata": metadata, "Rows": [header] + data}}]
+
+
+def fake_boto3(monkeypatch, athena, s3=None):
+    """Makes boto3.client return the given fake clients."""
+    from analytics.aws import athena_client
+
+    clients = {"athena": athena, "s3": s3}
+    monkeypatch.setattr(athena_client.boto3, "client", lambda name: clients[name])
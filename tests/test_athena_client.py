@@ -0,0 +1,35 @@
+from analytics.aws.athena_client import _flights
+from analytics.data_analysis.vehicle_data import VehicleData
+
+from fakes import FakeAthena, fake_boto3
+
+
+def test_timed_out_run_does_not_leave_its_query_in_flight(monkeypatch):
+    athena = FakeAthena()
+    fake_boto3(monkeypatch, athena)
+    monkeypatch.setenv("QUERY_TIMEOUT_SECS", "0")
+    monkeypatch.setenv("QUERY_STATUS_CHECK_INTERVAL_SECS", "0")
+
+    assert not VehicleData("db", "s3://bucket/output/").run()
+    assert athena.stopped == ["q0"]
+    assert not _flights
+
+    assert not VehicleData("db", "s3://bucket/output/").run()
+    assert [execution_id for execution_id, _ in athena.started] == ["q0", "q1"]
+
+
+def test_shared_query_keeps_running_until_its_last_caller_gives_up(monkeypatch):
+    athena = FakeAthena()
+    fake_boto3(monkeypatch, athena)
+    first = VehicleData("db", "s3://bucket/output/")._athena
+    second = VehicleData("db", "s3://bucket/output/")._athena
+
+    handle = first.submit("SELECT 1", coalesce=True)
+    assert second.submit("SELECT 1", coalesce=True) is handle
+    assert len(athena.started) == 1
+
+    first.abandon(handle)
+    assert athena.stopped == []
+    second.abandon(handle)
+    assert athena.stopped == ["q0"]
+    assert not _flights
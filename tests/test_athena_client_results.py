@@ -0,0 +1,99 @@
+import io
+
+from analytics.aws.athena_client import AthenClient
+
+from fakes import fake_boto3
+
+COLUMNS = [{"Name": "vehicle_type", "Type": "varchar"}, {"Name": "dist", "Type": "integer"}]
+
+
+class PagedAthena:
+    """A fake athena client whose results have more than one page."""
+
+    def __init__(self) -> None:
+        self.pages = 0
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, QueryExecutionId, **kwargs):
+        header = {"Data": [{"VarCharValue": "vehicle_type"}, {"VarCharValue": "dist"}]}
+        row = {"Data": [{"VarCharValue": "007"}, {"VarCharValue": "11"}]}
+        for _ in range(3):
+            self.pages += 1
+            yield {
+                "ResultSet": {"ResultSetMetadata": {"ColumnInfo": COLUMNS}, "Rows": [header, row]},
+                "NextToken": "next",
+            }
+            header = row
+
+
+class FakeS3:
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(b'"vehicle_type","dist"\n"007","11"\n')}
+
+
+def test_multi_page_results_are_downloaded_after_the_first_page(monkeypatch):
+    athena = PagedAthena()
+    fake_boto3(monkeypatch, athena, FakeS3())
+    client = AthenClient("db", "s3://bucket/output/")
+
+    data = client._download("q0")
+    assert athena.pages == 1
+    assert data["vehicle_type"].tolist() == ["007"]
+    assert data["dist"].tolist() == [11]
+
+
+def test_both_paths_decode_the_same_dtypes(monkeypatch):
+    fake_boto3(monkeypatch, PagedAthena(), FakeS3())
+    client = AthenClient("db", "s3://bucket/output/")
+    rows = [
+        {"Data": [{"VarCharValue": "vehicle_type"}, {"VarCharValue": "dist"}]},
+        {"Data": [{"VarCharValue": "007"}, {"VarCharValue": "11"}]},
+    ]
+
+    from_api = client._decode_rows(COLUMNS, rows)
+    from_s3 = client._decode_csv(client._download_csv("q0"), COLUMNS)
+    assert from_api.dtypes.tolist() == from_s3.dtypes.tolist()
+    assert from_api.equals(from_s3)
+
+
+class SizedAthena:
+    """A fake athena client which pages the given number of rows by the requested page size."""
+
+    def __init__(self, rows: int) -> None:
+        self.rows = rows
+        self.page_sizes = []
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, QueryExecutionId, PaginationConfig):
+        page_size = PaginationConfig["PageSize"]
+        self.page_sizes.append(page_size)
+        header = {"Data": [{"VarCharValue": "vehicle_type"}, {"VarCharValue": "dist"}]}
+        rows = [header] + [
+            {"Data": [{"VarCharValue": "007"}, {"VarCharValue": "11"}]}
+        ] * self.rows
+        for start in range(0, len(rows), page_size):
+            page = {
+                "ResultSet": {
+                    "ResultSetMetadata": {"ColumnInfo": COLUMNS},
+                    "Rows": rows[start : start + page_size],
+                }
+            }
+            if start + page_size < len(rows):
+                page["NextToken"] = "next"
+            yield page
+
+
+def test_results_above_max_api_rows_are_downloaded_from_s3(monkeypatch):
+    athena = SizedAthena(rows=900)
+    fake_boto3(monkeypatch, athena, FakeS3())
+    client = AthenClient("db", "s3://bucket/output/", max_api_rows=100)
+
+    assert len(client._download("q0")) == 1
+    assert athena.page_sizes == [101]
+
+    athena.rows = 100
+    assert len(client._download("q0")) == 100
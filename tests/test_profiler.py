@@ -0,0 +1,76 @@
+import json
+import sys
+
+from analytics.data_analysis import __main__ as cli
+from analytics.data_analysis.profiler import RunProfiler
+from analytics.data_analysis.vehicle_data import VehicleData
+
+from fakes import FakeAthena, fake_boto3
+
+
+def test_report_holds_each_phase_and_the_totals(tmp_path):
+    output = tmp_path / "profile.json"
+    profiler = RunProfiler(enabled=True, output=str(output))
+    with profiler.phase("build"):
+        pass
+    with profiler.phase("decode", trace_memory=True):
+        pass
+
+    report = profiler.report
+    assert [phase["name"] for phase in report["phases"]] == ["build", "decode"]
+    # Only the deep mode profiles the functions and traces the memory.
+    assert set(report["phases"][1]) == {"name", "wall_secs", "cpu_secs"}
+    assert report["total_wall_secs"] == round(
+        sum(phase["wall_secs"] for phase in report["phases"]), 6
+    )
+    assert json.loads(profiler.dump()) == report
+    assert json.loads(output.read_text()) == report
+
+    profiler.reset()
+    assert profiler.report["phases"] == []
+
+
+def test_deep_mode_captures_cprofile_and_allocations():
+    profiler = RunProfiler(deep=True)
+    with profiler.phase("decode", trace_memory=True):
+        [0] * 1000
+
+    phase = profiler.report["phases"][0]
+    assert profiler.enabled
+    assert phase["cprofile"]
+    assert phase["peak_memory_bytes"] > 0
+    assert phase["top_allocations"]
+
+
+def test_disabled_profiler_measures_nothing():
+    profiler = RunProfiler()
+    with profiler.phase("build"):
+        pass
+    assert profiler.report["phases"] == []
+
+
+def test_run_measures_the_download_apart_from_the_decoding(monkeypatch):
+    fake_boto3(monkeypatch, FakeAthena(succeed=True))
+    analytics = VehicleData("db", "s3://bucket/output/")
+    analytics.profiler = RunProfiler(enabled=True)
+
+    assert analytics.run()
+    assert [phase["name"] for phase in analytics.profiler.report["phases"]] == [
+        "build",
+        "submit",
+        "wait",
+        "download",
+        "decode",
+    ]
+
+
+def test_cli_writes_the_profile_report(monkeypatch, tmp_path):
+    output = tmp_path / "profile.json"
+    fake_boto3(monkeypatch, FakeAthena(succeed=True))
+    monkeypatch.setattr(
+        sys, "argv", ["analytics", "--profile", "--profile-output", str(output)]
+    )
+
+    assert cli.main() == 0
+    report = json.loads(output.read_text())
+    assert "decode" in [phase["name"] for phase in report["phases"]]
@@ -0,0 +1,93 @@
+import pytest
+
+from analytics.data_analysis.vehicle_data import VehicleData
+from analytics.sql.query_builder import RoundedDistanceQuery
+
+from fakes import FakeAthena, fake_boto3
+
+
+def test_partition_filters_without_conditions_add_no_where_clause():
+    query = RoundedDistanceQuery(set(), partition_filters={"dt": (None, None)})
+    query.build_query()
+    assert "WHERE" not in query.query
+
+
+def test_empty_partition_filters_are_rejected(monkeypatch):
+    fake_boto3(monkeypatch, FakeAthena())
+    analytics = VehicleData("db", "s3://bucket/output/")
+    with pytest.raises(ValueError):
+        analytics.set_time_range()
+    with pytest.raises(ValueError):
+        analytics.filter_partitions(dt=[])
+
+
+def test_missing_partitions_leave_out_the_open_partitions():
+    from analytics.sql.query_builder import MissingPartitionsQuery
+
+    query = MissingPartitionsQuery("src_rollup")
+    query.build_query()
+    assert "dt < (SELECT max(dt)\nFROM\n\tsrc)" in query.query
+
+    query = MissingPartitionsQuery("src_rollup", up_to="2024-01-07")
+    query.build_query()
+    assert "dt <= '2024-01-07'" in query.query
+    assert "max(dt)" not in query.query
+
+
+def test_rollup_groups_by_whole_meters():
+    from analytics.sql.query_builder import RollupQuery
+
+    query = RollupQuery("src_rollup", partitions=["2024-01-01"])
+    query.build_query()
+    meter = "CASE WHEN distance = floor(distance) THEN CAST(distance AS bigint) END"
+    assert f"{meter} AS distance_meter" in query.query
+    assert f"GROUP BY\n\tvehicle_type,\n\t{meter},\n\tdt" in query.query
+
+
+def test_metrics_keep_the_first_bin_when_it_starts_at_zero():
+    from analytics.sql.query_builder import MetricSpec, MetricsQuery
+
+    metrics = [MetricSpec(name="rows", func="count", field="*")]
+    query = MetricsQuery(set(), 0, 20, 10, metrics=metrics)
+    query.build_query()
+    assert "WHEN distance BETWEEN 0 AND 9 THEN 0" in query.query
+    assert "ELSE -1" in query.query
+    assert "WHERE dist != -1" in query.query
+
+
+def test_rollup_partitions_are_escaped():
+    from analytics.sql.query_builder import RollupQuery
+
+    query = RollupQuery("src_rollup", partitions=["2024-01-01", "it's"])
+    query.build_query()
+    assert "dt IN ('2024-01-01', 'it''s')" in query.query
+
+
+def test_rollup_metrics_are_computed_from_the_rollup_columns():
+    from analytics.sql.query_builder import MetricSpec, MetricsQuery, ROLLUP_METRICS
+
+    metrics = [
+        MetricSpec(name=f"{func}_{field}", func=func, field=field)
+        for func, field in ROLLUP_METRICS
+    ]
+    query = MetricsQuery(set(), 1, 20, 10, rollup_table="src_rollup", metrics=metrics)
+    query.build_query()
+    for expression in (
+        'sum(number_of_rows) AS "count_*"',
+        'sum(number_of_rows) AS "count_dist"',
+        'sum(number_of_rows) AS "count_distance"',
+        'sum(number_of_detections) AS "count_if_detection"',
+        'sum(distance_meter * number_of_rows) AS "sum_distance"',
+        'min(distance_meter) AS "min_distance"',
+        'max(distance_meter) AS "max_distance"',
+        '1.0E0 * sum(distance_meter * number_of_rows) / sum(number_of_rows) AS "avg_distance"',
+    ):
+        assert expression in query.query
+    assert "FROM\n\tsrc_rollup)" in query.query
+
+    with pytest.raises(ValueError):
+        MetricsQuery(
+            set(),
+            rollup_table="src_rollup",
+            metrics=[MetricSpec(name="speed", func="avg", field="speed")],
+        ).build_query()
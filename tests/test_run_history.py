@@ -0,0 +1,41 @@
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+
+from analytics.data_analysis.run_history import RunHistory
+from analytics.data_analysis.vehicle_data import VehicleData
+
+from fakes import FakeAthena, fake_boto3
+
+
+def test_rolling_window_runs_form_a_single_trend(monkeypatch, tmp_path):
+    fake_boto3(monkeypatch, FakeAthena())
+    history = RunHistory(str(tmp_path))
+    results = pd.DataFrame({"vehicle_type": ["truck"], "41_50": [50.0]})
+    analytics = VehicleData("db", "s3://bucket/output/")
+    start = datetime(2024, 1, 1)
+    for day in range(3):
+        analytics.set_time_range(
+            date(2024, 1, 1) + timedelta(days=day), date(2024, 1, 8) + timedelta(days=day)
+        )
+        history.append(analytics.config, results, start + timedelta(days=day))
+
+    trend = history.query(analytics.config, vehicle_type="truck", bin="41_50", last_runs=90)
+    assert len(trend) == 3
+    assert len(history.runs()["config"].map(lambda c: str(c["time_range"])).unique()) == 3
+
+
+def test_runs_of_other_partitions_form_other_trends(monkeypatch, tmp_path):
+    fake_boto3(monkeypatch, FakeAthena())
+    history = RunHistory(str(tmp_path))
+    configs = {}
+    for region, percentage in (("eu", 10.0), ("us", 90.0)):
+        analytics = VehicleData("db", "s3://bucket/output/")
+        analytics.set_time_range(date(2024, 1, 1), date(2024, 1, 7))
+        analytics.filter_partitions(region=region)
+        configs[region] = analytics.config
+        results = pd.DataFrame({"vehicle_type": ["truck"], "41_50": [percentage]})
+        history.append(analytics.config, results)
+
+    assert history.query(configs["eu"])["value"].tolist() == [10.0]
+    assert history.query(configs["us"])["value"].tolist() == [90.0]
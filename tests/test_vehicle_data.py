@@ -0,0 +1,148 @@
+import time
+
+import pandas as pd
+import pytest
+
+from analytics.data_analysis.vehicle_data import VehicleData
+
+from fakes import FakeAthena, fake_boto3
+
+
+def test_refresh_rollup_drops_the_cached_counts(monkeypatch):
+    fake_boto3(monkeypatch, FakeAthena(succeed=True))
+    analytics = VehicleData("db", "s3://bucket/output/")
+    analytics.use_rollup("src_rollup")
+    analytics.cache_counts()
+    analytics._counts_cache.append(("scope", (1, 100, 10), pd.DataFrame(), 0.0))
+
+    assert analytics.refresh_rollup(["2024-01-01"])
+    assert not analytics._counts_cache
+
+
+def test_counts_derived_pivot_matches_the_true_detections_query(monkeypatch):
+    import sqlite3
+
+    from analytics.sql.query_builder import FromClause, TrueDetectionsQuery
+
+    class TrueDetectionsOverCounts(TrueDetectionsQuery):
+        def build_from(self) -> str:
+            fromc = FromClause("counts")
+            fromc.build()
+            return fromc.clause
+
+    counts = pd.DataFrame(
+        {
+            "vehicle_type": ["bus", "car", "car", "car", "ignore", "truck"],
+            "dist": [1, 1, 11, -1, 1, 11],
+            "number_of_dist": [3, 7, 9, 4, 2, 6],
+            "number_of_detections": [1, 2, 9, 1, 1, 5],
+        }
+    )
+    fake_boto3(monkeypatch, FakeAthena())
+    analytics = VehicleData("db", "s3://bucket/output/")
+    analytics.set_boundaries(1, 20, 10)
+    analytics.exclude_vehicles({"bus"})
+
+    query = TrueDetectionsOverCounts({"bus"}, 1, 20, 10)
+    query.build_query()
+    with sqlite3.connect(":memory:") as connection:
+        counts.to_sql("counts", connection, index=False)
+        expected = pd.read_sql(query.query, connection)
+
+    pd.testing.assert_frame_equal(analytics._true_detections(counts), expected)
+
+
+def test_results_are_fetched_from_the_query_own_handle(monkeypatch):
+    athena = FakeAthena(
+        succeed=True,
+        results={"SELECT 1": (["a"], [[1]]), "SELECT 2": (["a"], [[2]])},
+    )
+    fake_boto3(monkeypatch, athena)
+    analytics = VehicleData("db", "s3://bucket/output/")
+
+    handle = analytics._execute("SELECT 1")
+    analytics._athena.execute("SELECT 2")
+    assert analytics._fetch(handle)["a"].tolist() == [1]
+
+
+def test_timed_out_rollup_write_is_not_cancelled(monkeypatch):
+    athena = FakeAthena()
+    fake_boto3(monkeypatch, athena)
+    monkeypatch.setenv("QUERY_TIMEOUT_SECS", "0")
+    monkeypatch.setenv("WRITE_QUERY_TIMEOUT_SECS", "0")
+    monkeypatch.setenv("QUERY_STATUS_CHECK_INTERVAL_SECS", "0")
+    analytics = VehicleData("db", "s3://bucket/output/")
+    analytics.use_rollup("src_rollup")
+
+    assert not analytics.refresh_rollup(["2024-01-01"])
+    assert athena.started[0][1].startswith("INSERT INTO")
+    assert athena.stopped == []
+
+
+def test_metrics_are_indexed_by_vehicle_type_and_bin_name(monkeypatch):
+    fake_boto3(monkeypatch, FakeAthena())
+    analytics = VehicleData("db", "s3://bucket/output/")
+    analytics.set_boundaries(0, 20, 10)
+    data = pd.DataFrame(
+        {"vehicle_type": ["car", "car"], "dist": [0, 10], "rows": [3, 4]}
+    )
+
+    results = analytics._index_by_bin(data)
+    assert results.index.names == ["vehicle_type", "bin"]
+    assert results.index.tolist() == [("car", "0_9"), ("car", "10_19")]
+    assert results["rows"].tolist() == [3, 4]
+
+
+@pytest.mark.parametrize(
+    "cached, bounds, expected",
+    [
+        ((1, 100, 5), (1, 100, 5), True),
+        ((1, 100, 5), (1, 100, 10), True),
+        ((1, 100, 5), (6, 95, 10), True),
+        ((1, 100, 5), (6, 100, 10), False),
+        ((1, 100, 5), (1, 50, 10), True),
+        ((1, 100, 5), (1, 100, 7), False),
+        ((1, 100, 5), (3, 100, 10), False),
+        ((1, 100, 5), (0, 100, 10), False),
+        ((1, 100, 5), (1, 110, 10), False),
+        ((0, 99, 10), (0, 99, 20), True),
+        ((0, 99, 10), (10, 99, 30), True),
+        ((0, 99, 10), (5, 99, 10), False),
+    ],
+)
+def test_subsumes(cached, bounds, expected):
+    assert VehicleData._subsumes(cached, bounds) is expected
+
+
+def test_counts_expire_after_max_age(monkeypatch):
+    counts = pd.DataFrame(
+        {
+            "vehicle_type": ["car"],
+            "dist": [1],
+            "number_of_dist": [2],
+            "number_of_detections": [1],
+        }
+    )
+    from analytics.sql.query_builder import CountedDistancesQuery
+
+    query = CountedDistancesQuery(set(), 1, 100, 10)
+    query.build_query()
+    athena = FakeAthena(
+        succeed=True,
+        results={query.query: (list(counts.columns), [["car", 1, 4, 4]])},
+    )
+    fake_boto3(monkeypatch, athena)
+    analytics = VehicleData("db", "s3://bucket/output/")
+    analytics.cache_counts(max_age_secs=60)
+    analytics._counts_cache.append(
+        (analytics._counts_scope(), (1, 100, 10), counts, time.monotonic())
+    )
+
+    assert analytics.run()
+    assert not athena.started
+    assert analytics.results["1_10"].tolist() == [50.0]
+
+    monkeypatch.setattr(time, "monotonic", lambda: analytics._counts_cache[0][3] + 61)
+    assert analytics.run()
+    assert [started for _, started in athena.started] == [query.query]
+    assert analytics.results["1_10"].tolist() == [100.0]